@@ -1,4 +1,4 @@
-import os, json, base64, mimetypes, random
+import os, json, base64, mimetypes, random, threading, zipfile
 from datetime import datetime
 import pandas as pd
 import streamlit as st
@@ -41,11 +41,31 @@ try:
 except Exception:
     QR_AVAILABLE = False
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PARQUET_AVAILABLE = True
+except Exception:
+    PARQUET_AVAILABLE = False
+
+EXPORT_DIR = os.path.join("out", "exports")
+EXPORT_CHUNK_RECORDS = 2000
+EXPORT_CHUNK_ROWS = 50000
+EXPORT_POLL_SECONDS = 1.0
+
+STATUS_CATEGORIES = ["Active", "Redeemed", "Expired"]
+ACTIVE_CODE = STATUS_CATEGORIES.index("Active")
+EXPIRY_FORMAT = "%Y-%m-%d"
+EXPIRY_RAW_COL = "Expiry (as entered)"
+
 # Initialize session state
 for key, default in [
     ("df", None), ("last_uploaded_name", None), ("picked_serials", set()),
     ("editor_nonce", 0), ("show_qr_dialog", False), ("qr_title", ""),
-    ("qr_path", ""), ("undo_stack", [])
+    ("qr_path", ""), ("undo_stack", []), ("export_paths", {}), ("export_job", None),
+    ("export_error", ""), ("reopen_export_dialog", False),
+    ("expiry_index", None), ("unparsed_expiry", []),
+    ("serial_rows", {})
 ]:
     st.session_state.setdefault(key, default)
 
@@ -75,6 +95,82 @@ df["Passenger"] = df["Passenger"].astype(str)
 df["Voucher Serial No."] = df["Voucher Serial No."].astype(str)
 df["SGV Amount"] = pd.to_numeric(df["SGV Amount"], errors="coerce")
 
+def normalize_status_and_expiry(base_df):
+    # Parse once per loaded table; later reruns see categorical/datetime64 columns and skip
+    changed = False
+    if not isinstance(base_df["Status"].dtype, pd.CategoricalDtype):
+        status = base_df["Status"].astype("string").str.strip().str.capitalize()
+        status = status.where(status != "")
+        extras = sorted(set(status.dropna().unique()) - set(STATUS_CATEGORIES))
+        base_df["Status"] = pd.Categorical(status, categories=STATUS_CATEGORIES + extras)
+        changed = True
+    if not pd.api.types.is_datetime64_any_dtype(base_df["Date of Expiry"]):
+        raw = base_df["Date of Expiry"].astype("string").fillna("").str.strip()
+        base_df[EXPIRY_RAW_COL] = raw.astype(object)
+        base_df["Date of Expiry"] = pd.to_datetime(raw.where(raw != ""), format=EXPIRY_FORMAT, errors="coerce")
+        changed = True
+    return changed
+
+def unparsed_expiry_serials(base_df):
+    bad = (base_df[EXPIRY_RAW_COL] != "") & base_df["Date of Expiry"].isna()
+    return base_df.loc[bad, "Voucher Serial No."].tolist()
+
+def expiry_reference(ref_time=None):
+    # Expiry dates are local calendar dates, so compare against the local date rather than UTC
+    return pd.Timestamp(ref_time if ref_time is not None else datetime.now().date())
+
+def build_serial_rows(base_df):
+    return dict(zip(base_df["Voucher Serial No."], base_df.index))
+
+def rows_for_serials(serials):
+    rows = st.session_state["serial_rows"]
+    return [rows[sn] for sn in serials if sn in rows]
+
+def active_expiries(base_df):
+    keep = (base_df["Status"].cat.codes == ACTIVE_CODE) & base_df["Date of Expiry"].notna()
+    return pd.Series(base_df.loc[keep, "Date of Expiry"].to_numpy(),
+                     index=base_df.loc[keep, "Voucher Serial No."].to_numpy())
+
+def add_to_expiry_index(entries):
+    idx = st.session_state.get("expiry_index")
+    if idx is not None and not idx.empty:
+        entries = pd.concat([idx, entries])
+    entries = entries[~entries.index.duplicated(keep="last")]
+    st.session_state["expiry_index"] = entries.sort_values(kind="stable")
+
+def remove_from_expiry_index(serials):
+    idx = st.session_state.get("expiry_index")
+    if idx is not None and not idx.empty:
+        st.session_state["expiry_index"] = idx[~idx.index.isin(serials)]
+
+def sweep_expired(base_df, ref_time=None):
+    # Expiry index holds Active serials sorted by expiry, so due vouchers are always a prefix
+    idx = st.session_state.get("expiry_index")
+    if idx is None or idx.empty:
+        return 0
+    cut = int(idx.searchsorted(expiry_reference(ref_time), side="left"))
+    if cut == 0:
+        return 0
+    due = idx.index[:cut]
+    st.session_state["expiry_index"] = idx.iloc[cut:]
+    # Only the due rows are touched, located through the serial -> row label map
+    status = base_df.loc[rows_for_serials(due), "Status"]
+    hit = status.index[status.cat.codes.to_numpy() == ACTIVE_CODE]
+    base_df.loc[hit, "Status"] = "Expired"
+    return len(hit)
+
+if normalize_status_and_expiry(df):
+    st.session_state["expiry_index"] = None
+    st.session_state["unparsed_expiry"] = unparsed_expiry_serials(df)
+    st.session_state["serial_rows"] = build_serial_rows(df)
+    add_to_expiry_index(active_expiries(df))
+sweep_expired(df)
+
+if st.session_state["unparsed_expiry"]:
+    bad = st.session_state["unparsed_expiry"]
+    st.warning(f"{len(bad)} voucher(s) have an expiry date not in {EXPIRY_FORMAT} format and will not expire automatically "
+               f"(e.g. {', '.join(bad[:3])}). See the '{EXPIRY_RAW_COL}' column.")
+
 @st.dialog("⚙️ Settings")
 def open_settings_dialog():
     st.subheader("Settings")
@@ -112,7 +208,7 @@ toolbar_placeholder = st.container()
 
 view = df[df["Passenger"] == passenger].copy()
 if only_active:
-    view = view[view["Status"].astype(str).str.lower() == "active"]
+    view = view[view["Status"].cat.codes == ACTIVE_CODE]
 view = view.reset_index(drop=True)
 
 table = view.copy()
@@ -129,6 +225,7 @@ edited = st.data_editor(
         "Select": st.column_config.CheckboxColumn(""),
         "SGV Amount": st.column_config.NumberColumn(format="%d"),
         "Date of Expiry": st.column_config.DateColumn(format="YYYY-MM-DD"),
+        EXPIRY_RAW_COL: st.column_config.TextColumn(EXPIRY_RAW_COL) if st.session_state["unparsed_expiry"] else None,
     },
     disabled=[c for c in table.columns if c != "Select"],
     key=f"editor_{passenger}_{only_active}_{st.session_state['editor_nonce']}",
@@ -147,7 +244,8 @@ picked_rows_current_pax = df[df["Voucher Serial No."].isin(picked_list) & (df["P
 selected_metric.metric("Selected", len(picked_rows_current_pax))
 
 total_value = float(picked_rows_current_pax["SGV Amount"].fillna(0).sum()) if not picked_rows_current_pax.empty else 0.0
-can_combine = (len(picked_rows_current_pax) >= 2) and (not cross_passenger)
+inactive_picked = bool((picked_rows_current_pax["Status"].cat.codes != ACTIVE_CODE).any())
+can_combine = (len(picked_rows_current_pax) >= 2) and (not cross_passenger) and (not inactive_picked)
 
 combine_clicked = combine_slot.button("Combine selected", type="primary", disabled=not can_combine)
 clear_clicked = clear_slot.button("Clear selection", type="secondary")
@@ -159,6 +257,8 @@ if clear_clicked:
 
 if cross_passenger:
     st.warning("eSGVs cannot be combined with multiple passengers. Please clear selection.")
+elif inactive_picked:
+    st.warning("Only Active eSGVs can be combined. Please deselect Redeemed or Expired vouchers.")
 
 def new_serial(prefix="SR1000000"):
     existing = set(st.session_state["df"]["Voucher Serial No."].astype(str))
@@ -172,7 +272,8 @@ def new_serial(prefix="SR1000000"):
 def generate_qr_and_update(picked_serials, passenger_name):
     base_df = st.session_state["df"]
     picked_rows = base_df[base_df["Voucher Serial No."].isin(picked_serials) & 
-                          (base_df["Passenger"] == passenger_name)].copy()
+                          (base_df["Passenger"] == passenger_name) &
+                          (base_df["Status"].cat.codes == ACTIVE_CODE)].copy()
     if len(picked_rows) < 2: 
         return
     
@@ -200,6 +301,7 @@ def generate_qr_and_update(picked_serials, passenger_name):
     
     mask = base_df["Voucher Serial No."].isin(source_serials) & (base_df["Passenger"] == passenger_name)
     base_df.loc[mask, "Status"] = "Redeemed"
+    remove_from_expiry_index(source_serials)
     
     new_row = {
         "Seat No.":"", 
@@ -207,9 +309,14 @@ def generate_qr_and_update(picked_serials, passenger_name):
         "Voucher Serial No.": new_sn, 
         "SGV Amount": total, 
         "Status":"Redeemed", 
-        "Date of Expiry": ""
+        "Date of Expiry": pd.NaT,
+        EXPIRY_RAW_COL: ""
     }
-    st.session_state["df"] = pd.concat([base_df, pd.DataFrame([new_row])], ignore_index=True)
+    # Row labels stay stable across combine/revert so the serial -> row map never needs rebuilding
+    new_label = int(base_df.index.max()) + 1 if len(base_df) else 0
+    new_df = pd.DataFrame([new_row], index=[new_label]).astype(base_df[["Status", "Date of Expiry"]].dtypes.to_dict())
+    st.session_state["df"] = pd.concat([base_df, new_df])
+    st.session_state["serial_rows"][new_sn] = new_label
     st.session_state["undo_stack"].append({
         "type":"combine", 
         "passenger": passenger_name, 
@@ -247,9 +354,15 @@ def revert_combine_at_index(idx):
     
     src = rec.get("sources", [])
     if src: 
-        base_df.loc[base_df["Voucher Serial No."].isin(src), "Status"] = "Active"
-    base_df = base_df[base_df["Voucher Serial No."] != rec.get("new_serial")]
-    st.session_state["df"] = base_df.reset_index(drop=True)
+        labels = rows_for_serials(src)
+        lapsed = (base_df.loc[labels, "Date of Expiry"] < expiry_reference()).to_numpy()
+        base_df.loc[[lb for lb, gone in zip(labels, lapsed) if not gone], "Status"] = "Active"
+        base_df.loc[[lb for lb, gone in zip(labels, lapsed) if gone], "Status"] = "Expired"
+        add_to_expiry_index(active_expiries(base_df.loc[labels]))
+    new_label = st.session_state["serial_rows"].pop(rec.get("new_serial"), None)
+    if new_label is not None:
+        base_df = base_df.drop(index=new_label)
+    st.session_state["df"] = base_df
     
     try:
         if rec.get("qr_path") and os.path.exists(rec["qr_path"]): 
@@ -264,6 +377,14 @@ def revert_combine_at_index(idx):
     st.session_state["editor_nonce"] += 1
     st.rerun()
 
+def describe_revert_restore(rec):
+    src = st.session_state["df"].loc[rows_for_serials(rec.get("sources", []))]
+    n_lapsed = int((src["Date of Expiry"] < expiry_reference()).sum())
+    msg = f"restore {len(src) - n_lapsed} vouchers to Active"
+    if n_lapsed:
+        msg += f" and mark {n_lapsed} past-expiry voucher(s) as Expired"
+    return msg
+
 @st.dialog("Confirm Revert")
 def show_revert_confirm_dialog(pax):
     options = list_undo_records_for_passenger(pax)
@@ -271,10 +392,9 @@ def show_revert_confirm_dialog(pax):
         return
     idx, rec = options[0]
     new_sn = rec.get("new_serial", "")
-    count = len(rec.get("sources", []))
     total = rec.get("total_amount", 0.0)
     
-    st.warning(f"I confirm reverting the last combination for Passenger {pax}: remove {new_sn} (total ${total:,.2f}) and restore {count} vouchers to Active.")
+    st.warning(f"I confirm reverting the last combination for Passenger {pax}: remove {new_sn} (total ${total:,.2f}) and {describe_revert_restore(rec)}.")
     agree = st.checkbox("Yes, revert", value=False)
     if st.button("Revert now", type="primary", disabled=not agree) and agree:
         revert_combine_at_index(idx)
@@ -298,7 +418,7 @@ def show_revert_pick_dialog(pax):
     choice = st.selectbox("Pick a combined voucher to revert", 
                          options=list(range(len(indices))), 
                          format_func=lambda i: labels[i])
-    st.info("Confirm to revert the selected combined voucher.")
+    st.info(f"Confirm to revert the selected combined voucher: this will {describe_revert_restore(options[choice][1])}.")
     agree = st.checkbox("Yes, revert the selected voucher", value=False)
     if st.button("Revert now", type="primary", disabled=not agree) and agree:
         revert_combine_at_index(indices[choice])
@@ -320,9 +440,228 @@ def show_qr_dialog(title, img_path):
 if st.session_state.get("show_qr_dialog") and st.session_state.get("qr_path"):
     show_qr_dialog(st.session_state["qr_title"], st.session_state["qr_path"])
 
+RECON_SUMMARY_KEYS = ["Passenger"]
+STATUS_SUMMARY_KEYS = ["Passenger", "Status"]
+EXPORT_FILES = [
+    ("csv", "Reconciliation CSV", "text/csv"),
+    ("parquet", "Reconciliation Parquet", "application/octet-stream"),
+    ("summary", "Summary CSV", "text/csv"),
+    ("status", "Voucher status summary CSV", "text/csv"),
+    ("zip", "QR codes (ZIP)", "application/zip"),
+]
+
+def list_combine_records():
+    return [rec for rec in st.session_state.get("undo_stack", []) if rec.get("type") == "combine"]
+
+def iter_reconciliation_chunks(base_df, records, chunk_size=EXPORT_CHUNK_RECORDS):
+    # One row per source voucher; chunked by combine record so a combined serial never spans two chunks
+    lookup = base_df.drop_duplicates("Voucher Serial No.", keep="last").set_index("Voucher Serial No.")
+    for start in range(0, len(records), chunk_size):
+        detail = pd.DataFrame(records[start:start + chunk_size]).explode("sources", ignore_index=True)
+        src = detail["sources"].astype(str)
+        new = detail["new_serial"].astype(str)
+        yield pd.DataFrame({
+            "Combined Serial No.": new,
+            "Passenger": detail["passenger"].astype(str),
+            "Seat No.": src.map(lookup["Seat No."]).astype(object).fillna("").astype(str),
+            "Source Serial No.": src,
+            "Source Amount": pd.to_numeric(src.map(lookup["SGV Amount"]), errors="coerce").astype("float64"),
+            "Combined Total": pd.to_numeric(detail["total_amount"], errors="coerce").astype("float64"),
+            "Created At": detail["timestamp"].astype(str),
+            "QR Path": detail["qr_path"].astype(str),
+        })
+
+def summarize_reconciliation_chunk(chunk):
+    return chunk.groupby(RECON_SUMMARY_KEYS, sort=False).agg(
+        combined_vouchers=("Combined Serial No.", "nunique"),
+        source_vouchers=("Source Serial No.", "size"),
+        source_amount=("Source Amount", "sum"),
+        first_created=("Created At", "min"),
+        last_created=("Created At", "max"),
+    )
+
+def merge_reconciliation_summaries(partials):
+    if not partials:
+        return pd.DataFrame()
+    summary = pd.concat(partials).groupby(level=RECON_SUMMARY_KEYS).agg(
+        combined_vouchers=("combined_vouchers", "sum"),
+        source_vouchers=("source_vouchers", "sum"),
+        source_amount=("source_amount", "sum"),
+        first_created=("first_created", "min"),
+        last_created=("last_created", "max"),
+    )
+    return summary.reset_index().rename(columns={
+        "combined_vouchers": "Combined Vouchers", "source_vouchers": "Source Vouchers",
+        "source_amount": "Source Amount", "first_created": "First Combined At",
+        "last_created": "Last Combined At",
+    })
+
+def summarize_status_chunk(chunk):
+    return chunk.groupby(STATUS_SUMMARY_KEYS, sort=False, observed=True, dropna=False).agg(
+        vouchers=("Voucher Serial No.", "size"),
+        amount=("SGV Amount", "sum"),
+    )
+
+def merge_status_summaries(partials):
+    if not partials:
+        return pd.DataFrame(columns=STATUS_SUMMARY_KEYS + ["Vouchers", "SGV Amount"])
+    summary = pd.concat(partials).groupby(level=STATUS_SUMMARY_KEYS, dropna=False).sum()
+    return summary.reset_index().rename(columns={"vouchers": "Vouchers", "amount": "SGV Amount"})
+
+def qr_artifact_path(rec):
+    img_path = rec.get("qr_path", "")
+    if img_path and os.path.exists(img_path):
+        return img_path
+    json_path = img_path.replace(".png", ".json") if img_path else ""
+    return json_path if json_path and os.path.exists(json_path) else None
+
+def export_reconciliation(base_df, records, on_progress=None):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    stamp = datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+    paths = {
+        "csv": os.path.join(EXPORT_DIR, f"reconciliation_{stamp}.csv"),
+        "parquet": os.path.join(EXPORT_DIR, f"reconciliation_{stamp}.parquet") if PARQUET_AVAILABLE else "",
+        "summary": os.path.join(EXPORT_DIR, f"reconciliation_summary_{stamp}.csv"),
+        "status": os.path.join(EXPORT_DIR, f"voucher_status_summary_{stamp}.csv"),
+        "zip": os.path.join(EXPORT_DIR, f"qr_codes_{stamp}.zip"),
+    }
+    n_chunks = max(1, -(-len(records) // EXPORT_CHUNK_RECORDS))
+    try:
+        _write_reconciliation_files(base_df, records, paths, n_chunks, on_progress)
+    except BaseException:
+        # Never leave half-written exports behind
+        remove_export_files(paths)
+        raise
+    return paths
+
+def _write_reconciliation_files(base_df, records, paths, n_chunks, on_progress):
+    partials = []
+    writer = None
+    try:
+        with open(paths["csv"], "w", newline="", encoding="utf-8") as csv_f:
+            for i, chunk in enumerate(iter_reconciliation_chunks(base_df, records)):
+                chunk.to_csv(csv_f, header=(i == 0), index=False)
+                if PARQUET_AVAILABLE:
+                    if writer is None:
+                        table = pa.Table.from_pandas(chunk, preserve_index=False)
+                        writer = pq.ParquetWriter(paths["parquet"], table.schema)
+                    else:
+                        table = pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+                    writer.write_table(table)
+                partials.append(summarize_reconciliation_chunk(chunk))
+                if on_progress is not None:
+                    on_progress((i + 1) / (n_chunks + 1), f"Writing records ({i + 1}/{n_chunks})")
+    finally:
+        if writer is not None:
+            writer.close()
+
+    merge_reconciliation_summaries(partials).to_csv(paths["summary"], index=False)
+
+    status_partials = [summarize_status_chunk(base_df.iloc[start:start + EXPORT_CHUNK_ROWS])
+                       for start in range(0, len(base_df), EXPORT_CHUNK_ROWS)]
+    merge_status_summaries(status_partials).to_csv(paths["status"], index=False)
+
+    # Files are streamed from disk into the archive one at a time
+    with zipfile.ZipFile(paths["zip"], "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for rec in records:
+            artifact = qr_artifact_path(rec)
+            if artifact:
+                zf.write(artifact, arcname=os.path.basename(artifact))
+    if on_progress is not None:
+        on_progress(1.0, "Export complete")
+
+def start_export_job(base_df, records):
+    # Runs outside the script thread so reruns cannot interrupt it; the dialog polls the job dict
+    job = {"progress": 0.0, "text": "Starting export", "paths": None, "error": None, "done": False}
+
+    def on_progress(fraction, text):
+        job["progress"], job["text"] = fraction, text
+
+    def run():
+        try:
+            job["paths"] = export_reconciliation(base_df, records, on_progress)
+        except Exception as e:
+            job["error"] = str(e)
+        finally:
+            job["done"] = True
+
+    job["thread"] = threading.Thread(target=run, name="esgv-export", daemon=True)
+    job["thread"].start()
+    return job
+
+def remove_export_files(paths):
+    for path in paths.values():
+        try:
+            if path and os.path.exists(path):
+                os.remove(path)
+        except Exception:
+            pass
+
+def finish_export_job(job):
+    if job["error"]:
+        st.session_state["export_error"] = job["error"]
+    else:
+        remove_export_files(st.session_state.get("export_paths", {}))
+        st.session_state["export_paths"] = job["paths"]
+    st.session_state["export_job"] = None
+
+@st.fragment(run_every=EXPORT_POLL_SECONDS)
+def show_export_progress():
+    job = st.session_state.get("export_job")
+    if job is None:
+        return
+    if job["done"]:
+        # Full rerun to drop the timer; the dialog reopens with the download picker
+        finish_export_job(job)
+        st.session_state["reopen_export_dialog"] = True
+        st.rerun()
+    st.progress(job["progress"], text=job["text"])
+
+@st.dialog("Export Reconciliation")
+def show_export_dialog():
+    records = list_combine_records()
+    if not records:
+        st.info("No combined vouchers to export yet.")
+        return
+    n_sources = sum(len(rec.get("sources", [])) for rec in records)
+    st.write(f"{len(records)} combined voucher(s) from {n_sources} source voucher(s).")
+    if not PARQUET_AVAILABLE:
+        st.caption("Parquet export requires pyarrow; only CSV will be written.")
+
+    job = st.session_state.get("export_job")
+    if job is not None and job["done"]:
+        finish_export_job(job)
+        job = None
+    if st.session_state["export_error"]:
+        st.error(f"Export failed: {st.session_state['export_error']}")
+        st.session_state["export_error"] = ""
+
+    if job is None and st.button("Build export", type="primary"):
+        st.session_state["export_job"] = job = start_export_job(st.session_state["df"].copy(), list(records))
+    if job is not None:
+        show_export_progress()
+        return
+
+    paths = st.session_state.get("export_paths", {})
+    available = [(key, label, mime) for key, label, mime in EXPORT_FILES
+                 if paths.get(key) and os.path.exists(paths[key])]
+    if available:
+        choice = st.selectbox("File to download", options=list(range(len(available))), index=None,
+                              format_func=lambda i: available[i][1], placeholder="Choose a file")
+        if choice is not None:
+            key, label, mime = available[choice]
+            # Only the chosen file is handed to Streamlit's media store
+            with open(paths[key], "rb") as f:
+                st.download_button(f"Download {label}", data=f, file_name=os.path.basename(paths[key]), mime=mime)
+            st.caption("Downloading closes this dialog; reopen it to fetch another file.")
+
 # Navigation to KrisShop Inventory
 with st.popover("Navigate"):
     st.write("App preferences")
+    reopen_export = st.session_state["reopen_export_dialog"]
+    st.session_state["reopen_export_dialog"] = False
+    if st.button("Export reconciliation") or reopen_export:
+        show_export_dialog()
     if st.button("Go to KrisShop Inventory"):
         try:
             st.switch_page("pages/KrisShopInventory.py")